@@ -28,6 +28,7 @@ from sounds import MasterVolume
 
 if __name__ == "__main__":
     ui = UI()
+    master = None
 
     try:
         ui.start()
@@ -40,3 +41,5 @@ if __name__ == "__main__":
     except:
         ui.end()
         traceback.print_exc()
+        if master != None:
+            master.close()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014-2015 Muges
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import math
+import random
+import threading
+import time
+
+def is_finite(x):
+    """
+    Return True if the float x is neither infinite nor NaN
+    """
+    return not (math.isinf(x) or math.isnan(x))
+
+class Envelope:
+    """
+    Abstract class representing a gain (a float between 0 and 1) varying
+    over time, which is applied to the volume of a track
+    """
+
+    # Name of the envelope in the preset file
+    type = None
+
+    def start(self, t):
+        """
+        Start the envelope at the time t (in seconds since the epoch)
+        """
+        self.t0 = t
+
+    def evaluate(self, t):
+        """
+        Abstract method returning the gain at the time t (in seconds
+        since the epoch)
+        """
+        raise NotImplementedError()
+
+    def is_finished(self, t):
+        """
+        Return True if the gain will not change anymore after the time t
+        """
+        return False
+
+    def to_json(self):
+        """
+        Abstract method returning the parameters of the envelope as a
+        dictionary that can be stored in a preset
+        """
+        raise NotImplementedError()
+
+class DriftEnvelope(Envelope):
+    """
+    Envelope slowly drifting between random gains
+    """
+    type = "drift"
+
+    def __init__(self, depth=0.5, period=60.):
+        """
+        Initialize the envelope.
+
+        - depth is the maximal attenuation (between 0 and 1)
+        - period is the number of seconds taken to reach each random
+          gain
+        """
+        if not 0 <= depth <= 1 or not is_finite(period) or period <= 0:
+            raise ValueError("invalid drift envelope")
+        self.depth = depth
+        self.period = period
+
+    def _random_gain(self):
+        return 1 - self.depth*random.random()
+
+    def start(self, t):
+        Envelope.start(self, t)
+        self.previous = self._random_gain()
+        self.next = self._random_gain()
+
+    def evaluate(self, t):
+        # Choose the next random gains if the current period is over,
+        # skipping the periods that were never evaluated at once
+        if t - self.t0 >= self.period:
+            periods = math.floor((t - self.t0)/self.period)
+            self.t0 += periods*self.period
+            if periods == 1:
+                self.previous = self.next
+            else:
+                self.previous = self._random_gain()
+            self.next = self._random_gain()
+
+        # Interpolate between the previous and the next gain
+        x = min(max(0., (t - self.t0)/self.period), 1.)
+        return self.previous + (self.next - self.previous)*x
+
+    def to_json(self):
+        return {"type": self.type, "depth": self.depth, "period": self.period}
+
+class DayNightEnvelope(Envelope):
+    """
+    Envelope following a curve over the hours of the day
+    """
+    type = "daynight"
+
+    def __init__(self, points):
+        """
+        Initialize the envelope.
+
+        - points is a list of (hour, gain) pairs, the gain is linearly
+          interpolated between them and wraps around midnight
+        """
+        points = sorted((float(hour), float(gain)) for hour, gain in points)
+        if len(points) == 0:
+            raise ValueError("invalid day/night envelope")
+        for hour, gain in points:
+            if not 0 <= hour < 24 or not 0 <= gain <= 1:
+                raise ValueError("invalid day/night envelope")
+        self.points = points
+
+    def evaluate(self, t):
+        localtime = time.localtime(t)
+        hour = (localtime.tm_hour + localtime.tm_min/60. +
+                localtime.tm_sec/3600.)
+
+        # Find the points surrounding the current hour
+        previous = (self.points[-1][0] - 24, self.points[-1][1])
+        next = (self.points[0][0] + 24, self.points[0][1])
+        for point in self.points:
+            if point[0] <= hour:
+                previous = point
+            else:
+                next = point
+                break
+
+        if next[0] == previous[0]:
+            return previous[1]
+        x = (hour - previous[0])/(next[0] - previous[0])
+        return previous[1] + (next[1] - previous[1])*x
+
+    def to_json(self):
+        return {"type": self.type,
+                "points": [[hour, gain] for hour, gain in self.points]}
+
+class FadeOutEnvelope(Envelope):
+    """
+    Sleep timer, fading out the track after a delay
+    """
+    type = "fadeout"
+
+    def __init__(self, delay, duration=60.):
+        """
+        Initialize the envelope.
+
+        - delay is the number of seconds before the fade out starts
+        - duration is the number of seconds taken by the fade out
+        """
+        if (not is_finite(delay) or not is_finite(duration) or
+                delay < 0 or duration < 0):
+            raise ValueError("invalid fade out envelope")
+        self.delay = delay
+        self.duration = duration
+
+    def evaluate(self, t):
+        elapsed = t - self.t0 - self.delay
+        if elapsed >= self.duration:
+            return 0.
+        elif elapsed <= 0:
+            return 1.
+        else:
+            return 1 - elapsed/self.duration
+
+    def is_finished(self, t):
+        return t - self.t0 >= self.delay + self.duration
+
+    def to_json(self):
+        return {"type": self.type, "delay": self.delay,
+                "duration": self.duration}
+
+def envelope_from_json(data):
+    """
+    Create an envelope from a dictionary read from a preset, raise a
+    ValueError if it is invalid
+    """
+    try:
+        if data["type"] == DriftEnvelope.type:
+            return DriftEnvelope(float(data.get("depth", 0.5)),
+                                 float(data.get("period", 60.)))
+        elif data["type"] == DayNightEnvelope.type:
+            return DayNightEnvelope(data["points"])
+        elif data["type"] == FadeOutEnvelope.type:
+            return FadeOutEnvelope(float(data["delay"]),
+                                   float(data.get("duration", 60.)))
+    except (KeyError, TypeError):
+        pass
+    raise ValueError("invalid envelope")
+
+class AutomationScheduler:
+    """
+    Evaluates the envelopes of all the tracks in a background thread at
+    a fixed control rate, and updates the volume of the tracks whose
+    gain changed
+    """
+    def __init__(self, mastervolume, rate=4.):
+        """
+        Initialize the scheduler (without starting it).
+
+        - mastervolume is a reference to the MasterVolume object
+        - rate is the number of updates per second
+        """
+        self.mastervolume = mastervolume
+        self.period = 1./rate
+
+        # Set when at least one track may have unfinished envelopes
+        self.active = threading.Event()
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.active.set()
+
+    def wake(self):
+        """
+        Method that should be called when envelopes are set on a track
+        """
+        self.active.set()
+
+    def update(self, t):
+        """
+        Evaluate the envelopes at the time t, and return True if at least
+        one track has unfinished envelopes
+        """
+        active = False
+        for sound in self.mastervolume.get_sounds():
+            if sound.update_automation(t):
+                active = True
+        return active
+
+    def run(self):
+        while not self.stopped.is_set():
+            # Sleep until some envelopes are set
+            self.active.wait()
+
+            if self.stopped.wait(self.period):
+                break
+
+            self.active.clear()
+            if self.update(time.time()):
+                self.active.set()
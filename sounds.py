@@ -28,7 +28,11 @@ pygame.mixer.init(frequency=48000)
 
 import os.path
 import json
+import shutil
+import threading
+import time
 from mutagen.oggvorbis import OggVorbis
+from automation import AutomationScheduler, envelope_from_json
 
 class Volume:
     """
@@ -63,6 +67,14 @@ class Volume:
         """
         self.volume = min(max(0, int(volume)), 100)
         self._set_volume()
+        self._volume_changed()
+
+    def _volume_changed(self):
+        """
+        Method called after the volume has been set, which may be
+        implemented by the subclasses to be notified of the changes
+        """
+        pass
 
     def inc_volume(self, step):
         """
@@ -71,6 +83,12 @@ class Volume:
         """
         self.set_volume(self.volume+step)
 
+    def is_automated(self):
+        """
+        Return True if the volume is modified by automation envelopes
+        """
+        return False
+
 class Sound(Volume):
     """
     Sound object, the sound is extracted from an ogg file, and is
@@ -103,6 +121,19 @@ class Sound(Volume):
 
         # The pygame.mixer.Sound object (only loaded when necessary)
         self.sound = None
+
+        # The automation envelopes, and the gain (a float between 0 and
+        # 1) they currently apply to the volume
+        self.envelopes = []
+        self.gain = 1.
+
+        # The finished envelopes that were cancelled by a manual change
+        # of the volume (they are still stored in the preset)
+        self.cancelled = []
+
+        # The volume is set both by the user interface and by the
+        # automation scheduler
+        self.lock = threading.RLock()
     
     def __cmp__(self, other):
         """
@@ -120,19 +151,125 @@ class Sound(Volume):
         should not be called directly, it will be called by the
         set_volume method.
         """
-        if self.sound == None:
-            if self.get_volume() > 0:
-                # Load the sound and play it
-                self.sound = pygame.mixer.Sound(self.filename)
-                self.sound.set_volume((self.mastervolume.get_volume()*self.get_volume())/10000.)
-                self.sound.play(-1, 0, 2000)
-        else:
-            # Set the volume
-            self.sound.set_volume((self.mastervolume.get_volume()*self.get_volume())/10000.)
+        with self.lock:
+            if self.sound == None:
+                if self.get_volume() > 0:
+                    # Load the sound and play it
+                    self.sound = pygame.mixer.Sound(self.filename)
+                    self.sound.set_volume((self.mastervolume.get_volume()*self.get_volume()*self.gain)/10000.)
+                    self.sound.play(-1, 0, 2000)
+            else:
+                # Set the volume
+                self.sound.set_volume((self.mastervolume.get_volume()*self.get_volume()*self.gain)/10000.)
+
+    def set_gain(self, gain):
+        """
+        Set the gain applied by the automation envelopes (the volume is
+        only updated if the change is audible)
+        """
+        gain = min(max(0., gain), 1.)
+        with self.lock:
+            if gain == self.gain:
+                return
+
+            # Always reach the bounds exactly, so that a faded out track
+            # is silent
+            if abs(gain - self.gain) >= 0.001 or gain in (0., 1.):
+                self.gain = gain
+                self._set_volume()
+
+    def set_envelopes(self, envelopes):
+        """
+        Set the automation envelopes of the sound, and start them
+        """
+        t = time.time()
+        for envelope in envelopes:
+            envelope.start(t)
+
+        with self.lock:
+            self.envelopes = envelopes
+            self.cancelled = []
+            self.set_gain(self.evaluate_envelopes(t))
+
+        if envelopes:
+            self.mastervolume.automation.wake()
+
+    def get_active_envelopes(self):
+        """
+        Return the envelopes that were not cancelled
+        """
+        return [envelope for envelope in self.envelopes
+                if envelope not in self.cancelled]
+
+    def is_automated(self):
+        return len(self.get_active_envelopes()) > 0
+
+    def evaluate_envelopes(self, t):
+        """
+        Return the gain of the automation envelopes at the time t
+        """
+        gain = 1.
+        for envelope in self.get_active_envelopes():
+            gain *= envelope.evaluate(t)
+        return gain
+
+    def cancel_finished_envelopes(self, t):
+        """
+        Cancel the envelopes that are finished at the time t, so that a
+        track which has been faded out can be heard again
+        """
+        with self.lock:
+            finished = [envelope for envelope in self.get_active_envelopes()
+                        if envelope.is_finished(t)]
+            if not finished:
+                return
+
+            self.cancelled.extend(finished)
+            self.set_gain(self.evaluate_envelopes(t))
+
+        # The remaining envelopes may have been left aside by the
+        # scheduler
+        if self.is_automated():
+            self.mastervolume.automation.wake()
+
+    def update_automation(self, t):
+        """
+        Apply the gain of the automation envelopes at the time t, and
+        return False once it cannot change anymore (when all the
+        envelopes are finished, or when one of them has faded the sound
+        out for good)
+        """
+        with self.lock:
+            envelopes = self.get_active_envelopes()
+            if not envelopes:
+                return False
+
+            gain = 1.
+            finished = True
+            for envelope in envelopes:
+                value = envelope.evaluate(t)
+                if envelope.is_finished(t):
+                    if value == 0:
+                        self.set_gain(0.)
+                        return False
+                else:
+                    finished = False
+                gain *= value
+
+            self.set_gain(gain)
+            return not finished
+
+    def _volume_changed(self):
+        """
+        Cancel the finished envelopes, and notify the MasterVolume that
+        the preset may need to be saved
+        """
+        self.cancel_finished_envelopes(time.time())
+        self.mastervolume.sound_changed()
 
 class Preset:
     """
-    Stores volumes for each track
+    Stores volumes and automation envelopes for each track
     """
     def __init__(self, master, filename):
         """
@@ -143,12 +280,17 @@ class Preset:
         self.master = master
         self.filename = filename
         self.volumes = {}
-        
+
+        # The automation envelopes of each track, as stored in the file
+        self.automation = {}
+
     def apply(self):
         """
         Apply the preset
         """
         for sound in self.master.get_sounds():
+            sound.set_envelopes([envelope_from_json(data)
+                                 for data in self.automation.get(sound.name, [])])
             if self.volumes.has_key(sound.name):
                 sound.set_volume(self.volumes[sound.name])
             else:
@@ -167,23 +309,249 @@ class Preset:
             else:
                 self.volumes[sound.name] = volume
 
+            if volume == 0 or not sound.envelopes:
+                if self.automation.has_key(sound.name):
+                    self.automation.pop(sound.name)
+            else:
+                self.automation[sound.name] = [envelope.to_json()
+                                               for envelope in sound.envelopes]
+
+    def to_json(self):
+        """
+        Return the content of the preset file.
+
+        The volume of each track is stored as an integer, or as an object
+        containing the volume and the automation envelopes if the track
+        has some.
+        """
+        data = dict(self.volumes)
+        for name, envelopes in self.automation.items():
+            data[name] = {"volume": self.volumes[name],
+                          "automation": envelopes}
+        return data
+
+    def get_backup_filename(self):
+        """
+        Return the name of the file containing the last good copy of the
+        preset
+        """
+        return self.filename + ".bak"
+
+    def exists(self):
+        """
+        Return True if the preset or its backup exists
+        """
+        return (os.path.isfile(self.filename) or
+                os.path.isfile(self.get_backup_filename()))
+
+    def _load(self, filename):
+        """
+        Load and validate the volumes and automation envelopes stored in
+        the file `filename`, raise an IOError or a ValueError if it is
+        unreadable or invalid
+        """
+        with open(filename, "r") as f:
+            data = json.load(f)
+
+        if not isinstance(data, dict):
+            raise ValueError("the preset is not a JSON object")
+
+        volumes = {}
+        automation = {}
+        for name, volume in data.items():
+            if isinstance(volume, dict):
+                envelopes = volume.get("automation", [])
+                if not isinstance(envelopes, list):
+                    raise ValueError("invalid automation for %s" % name)
+                for envelope in envelopes:
+                    envelope_from_json(envelope)
+                if envelopes:
+                    automation[name] = envelopes
+                volume = volume.get("volume")
+
+            if (isinstance(volume, bool) or
+                    not isinstance(volume, (int, long)) or
+                    not 0 <= volume <= 100):
+                raise ValueError("invalid volume for %s" % name)
+            volumes[name] = volume
+
+        return volumes, automation
+
     def read(self):
         """
-        Read the preset from the file
+        Read the preset from the file, falling back to the last good copy
+        if the file is missing or invalid. Return False if neither could
+        be read.
         """
-        # TODO : handle errors
-        with open(self.filename, "r") as f:
-            self.volumes = json.load(f)
+        for filename in (self.filename, self.get_backup_filename()):
+            try:
+                self.volumes, self.automation = self._load(filename)
+                return True
+            except (IOError, ValueError):
+                pass
+
+        self.volumes = {}
+        self.automation = {}
+        return False
 
     def write(self):
         """
-        Write the preset to the file
+        Write the preset to the file.
+
+        The preset is written to a temporary file which then atomically
+        replaces the previous one. If the previous one is valid, it is
+        first copied to the backup file, which is therefore always the
+        last good copy. Raise an IOError or an OSError on failure.
+        """
+        dirname = os.path.dirname(self.filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmpfilename = self.filename + ".tmp"
+        try:
+            with open(tmpfilename, "w") as f:
+                json.dump(self.to_json(), f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._backup()
+            os.rename(tmpfilename, self.filename)
+        except:
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+            raise
+
+    def _backup(self):
+        """
+        Atomically copy the preset file to the backup file, unless it is
+        missing or invalid
+        """
+        try:
+            self._load(self.filename)
+        except (IOError, ValueError):
+            return
+
+        backupfilename = self.get_backup_filename()
+        tmpfilename = backupfilename + ".tmp"
+        try:
+            shutil.copyfile(self.filename, tmpfilename)
+            os.rename(tmpfilename, backupfilename)
+        except:
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+            raise
+
+class AutoSaver:
+    """
+    Writes a preset in a background thread once the volumes have not
+    been changed for a given delay
+    """
+    def __init__(self, preset, delay=2.):
+        """
+        Initialize the object.
+
+        - preset is the Preset object that will be saved
+        - delay is the number of seconds to wait after the last change
+          before writing the preset
         """
-        # TODO : handle errors
-        if not os.path.exists(os.path.dirname(self.filename)):
-            os.makedirs(os.path.dirname(self.filename))
-        with open(self.filename, "w") as f:
-            json.dump(self.volumes, f)
+        self.preset = preset
+        self.delay = delay
+        self.enabled = True
+
+        # The content that is currently stored in the file (used to
+        # skip writes when nothing changed)
+        self.written = preset.to_json()
+
+        # Protects the timer
+        self.lock = threading.Lock()
+        self.timer = None
+
+        # Ensures that only one write happens at a time
+        self.writelock = threading.Lock()
+
+        # Message describing the last error, cleared once the preset is
+        # successfully written
+        self.error = None
+
+    def set_enabled(self, enabled):
+        """
+        Enable or disable the autosave, a pending save is written
+        immediately when it is disabled
+        """
+        self.enabled = enabled
+        if not enabled:
+            with self.lock:
+                pending = self.timer is not None
+            if pending:
+                self.save_soon()
+
+    def schedule(self):
+        """
+        Write the preset once `delay` seconds have passed without any
+        other call to this method (does nothing if the autosave is
+        disabled)
+        """
+        if self.enabled:
+            self._start_timer(self.delay)
+
+    def save_soon(self):
+        """
+        Write the preset in the background as soon as possible
+        """
+        self._start_timer(0)
+
+    def _start_timer(self, delay):
+        """
+        Replace the pending save by one happening after `delay` seconds
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(delay, self.save)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """
+        Write the pending save immediately, if there is one, or wait for
+        the write in progress to finish
+        """
+        with self.lock:
+            pending = self.timer is not None
+        if pending:
+            self.save()
+        else:
+            with self.writelock:
+                pass
+
+    def save(self):
+        """
+        Save the current settings and write them if they changed since
+        the last write. Return False if the preset could not be written
+        (the error is then stored in the error attribute).
+        """
+        with self.writelock:
+            # The timer is only cleared once the write lock is held, so
+            # that flush waits for this write
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+            self.preset.save()
+            data = self.preset.to_json()
+            if data == self.written:
+                return True
+
+            try:
+                self.preset.write()
+            except (IOError, OSError) as e:
+                self.error = "could not write the preset (%s)" % e
+                return False
+
+            self.written = data
+            self.error = None
+            return True
 
 class MasterVolume(Volume):
     """
@@ -210,17 +578,58 @@ class MasterVolume(Volume):
         
         pygame.mixer.set_num_channels(len(self.sounds))
 
+        # Evaluates the automation envelopes of the sounds
+        self.automation = AutomationScheduler(self)
+        self.automation.start()
+
         # Get the preset
         self.presetpath = os.path.expanduser("~/.config/ambientsounds/preset.json")
-        if os.path.isfile(self.presetpath):
-            preset = Preset(self, self.presetpath)
-            preset.read()
-            preset.apply()
+        self.preset = Preset(self, self.presetpath)
+        readable = not self.preset.exists() or self.preset.read()
+
+        self.autosaver = AutoSaver(self.preset)
+        if not readable:
+            self.autosaver.error = "could not read the preset"
+        self.preset.apply()
 
     def save_preset(self):
-        preset = Preset(self, self.presetpath)
-        preset.save()
-        preset.write()
+        """
+        Write the current settings to the preset file in the background
+        (the errors are reported by get_preset_error)
+        """
+        self.autosaver.save_soon()
+
+    def get_autosave(self):
+        """
+        Return True if the preset is automatically saved
+        """
+        return self.autosaver.enabled
+
+    def get_preset_error(self):
+        """
+        Return a message describing the last error that occurred while
+        reading or writing the preset, or None
+        """
+        return self.autosaver.error
+
+    def toggle_autosave(self):
+        """
+        Enable or disable the automatic saving of the preset
+        """
+        self.autosaver.set_enabled(not self.autosaver.enabled)
+
+    def sound_changed(self):
+        """
+        Method called when the volume of one of the sounds changed
+        """
+        self.autosaver.schedule()
+
+    def close(self):
+        """
+        Write the pending changes and stop the automation before exiting
+        """
+        self.automation.stop()
+        self.autosaver.flush()
 
     def get_sounds(self):
         """
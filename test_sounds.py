@@ -0,0 +1,414 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014-2015 Muges
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+class FakeSound:
+    """
+    Replaces pygame.mixer.Sound, counting the loaded sounds
+    """
+    loaded = []
+
+    # Functions called while a sound is loaded
+    hooks = []
+
+    def __init__(self, filename):
+        FakeSound.loaded.append(filename)
+        for hook in FakeSound.hooks:
+            hook()
+
+    def set_volume(self, volume):
+        pass
+
+    def play(self, loops, maxtime, fade_ms):
+        pass
+
+class FakeMixer:
+    Sound = FakeSound
+
+    def init(self, frequency):
+        pass
+
+    def set_num_channels(self, count):
+        pass
+
+# Replace pygame and mutagen, so that sounds can be imported without a
+# sound card or ogg files
+pygame = types.ModuleType("pygame")
+pygame.mixer = FakeMixer()
+sys.modules["pygame"] = pygame
+
+mutagen = types.ModuleType("mutagen")
+oggvorbis = types.ModuleType("mutagen.oggvorbis")
+oggvorbis.OggVorbis = lambda filename: {"title": [os.path.splitext(filename)[0]]}
+sys.modules["mutagen"] = mutagen
+sys.modules["mutagen.oggvorbis"] = oggvorbis
+
+from automation import (AutomationScheduler, DayNightEnvelope, DriftEnvelope,
+                        FadeOutEnvelope, envelope_from_json)
+from sounds import AutoSaver, Preset, Sound, Volume
+
+class FakeMasterVolume(Volume):
+    def __init__(self):
+        Volume.__init__(self, "Master", 100)
+        self.sounds = []
+        self.automation = AutomationScheduler(self)
+
+    def get_sounds(self):
+        return self.sounds
+
+    def sound_changed(self):
+        pass
+
+class SoundTest(unittest.TestCase):
+    def setUp(self):
+        FakeSound.loaded = []
+        self.master = FakeMasterVolume()
+        self.sound = Sound("rain.ogg", self.master)
+        self.master.sounds.append(self.sound)
+
+    def tearDown(self):
+        FakeSound.hooks = []
+
+    def test_sound_is_locked_while_loaded(self):
+        """
+        The automation scheduler cannot set the volume while the user
+        interface loads the sound, and does not load it a second time
+        """
+        self.sound.set_envelopes([DriftEnvelope(1., 10.)])
+        t = self.sound.envelopes[0].t0
+
+        acquired = []
+        def try_lock():
+            acquired.append(self.sound.lock.acquire(False))
+        def on_load():
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+        FakeSound.hooks = [on_load]
+
+        self.sound.set_volume(10)
+        self.assertEqual(acquired, [False])
+
+        FakeSound.hooks = []
+        for i in range(10):
+            self.master.automation.update(t + i)
+        self.assertEqual(FakeSound.loaded.count(self.sound.filename), 1)
+
+    def test_automation_does_not_load_muted_sound(self):
+        self.sound.set_envelopes([DriftEnvelope(1., 10.)])
+        t = self.sound.envelopes[0].t0
+
+        self.assertTrue(self.master.automation.update(t + 5))
+        self.assertEqual(self.sound.sound, None)
+
+    def test_automation_stops_after_fade_out(self):
+        """
+        The scheduler stops updating a track once a fade out is
+        finished, even if the track has other envelopes
+        """
+        self.sound.set_envelopes([DriftEnvelope(0.5, 1.),
+                                  FadeOutEnvelope(10., 20.)])
+        t = self.sound.envelopes[0].t0
+
+        self.assertTrue(self.master.automation.update(t + 5))
+        self.assertTrue(self.master.automation.update(t + 25))
+        self.assertTrue(self.sound.gain > 0)
+        self.assertFalse(self.master.automation.update(t + 30))
+        self.assertEqual(self.sound.gain, 0.)
+
+    def test_volume_change_cancels_finished_fade_out(self):
+        self.sound.set_envelopes([FadeOutEnvelope(0., 0.)])
+        self.assertEqual(self.sound.gain, 0.)
+        self.assertTrue(self.sound.is_automated())
+
+        self.sound.set_volume(10)
+        self.assertEqual(self.sound.gain, 1.)
+        self.assertFalse(self.sound.is_automated())
+        self.assertEqual(len(self.sound.envelopes), 1)
+
+class EnvelopeTest(unittest.TestCase):
+    def localtime(self, hour, minute=0):
+        """
+        Return the time of the given local hour
+        """
+        return time.mktime((2015, 6, 1, hour, minute, 0, 0, 0, -1))
+
+    def test_day_night_wraps_around_midnight(self):
+        envelope = DayNightEnvelope([[22, 0.5], [6, 1]])
+
+        self.assertAlmostEqual(envelope.evaluate(self.localtime(6)), 1.)
+        self.assertAlmostEqual(envelope.evaluate(self.localtime(14)), 0.75)
+        self.assertAlmostEqual(envelope.evaluate(self.localtime(22)), 0.5)
+        self.assertAlmostEqual(envelope.evaluate(self.localtime(23)), 0.5625)
+        self.assertAlmostEqual(envelope.evaluate(self.localtime(0)), 0.625)
+        self.assertAlmostEqual(envelope.evaluate(self.localtime(2)), 0.75)
+
+    def test_day_night_single_point(self):
+        envelope = DayNightEnvelope([[12, 0.3]])
+        self.assertAlmostEqual(envelope.evaluate(self.localtime(3)), 0.3)
+
+    def test_fade_out(self):
+        envelope = FadeOutEnvelope(10., 20.)
+        envelope.start(100.)
+
+        self.assertEqual(envelope.evaluate(105.), 1.)
+        self.assertEqual(envelope.evaluate(110.), 1.)
+        self.assertAlmostEqual(envelope.evaluate(115.), 0.75)
+        self.assertAlmostEqual(envelope.evaluate(120.), 0.5)
+        self.assertEqual(envelope.evaluate(130.), 0.)
+        self.assertEqual(envelope.evaluate(200.), 0.)
+
+        self.assertFalse(envelope.is_finished(129.))
+        self.assertTrue(envelope.is_finished(130.))
+
+    def test_drift_bounds(self):
+        random.seed(1)
+        envelope = DriftEnvelope(0.3, 10.)
+        envelope.start(0.)
+
+        for t in range(0, 1000, 3):
+            gain = envelope.evaluate(t)
+            self.assertTrue(0.7 <= gain <= 1., gain)
+        self.assertFalse(envelope.is_finished(1000.))
+
+    def test_drift_catches_up_after_clock_jump(self):
+        random.seed(1)
+        envelope = DriftEnvelope(0.5, 0.0001)
+        envelope.start(0.)
+
+        gain = envelope.evaluate(3600.)
+        self.assertTrue(0.5 <= gain <= 1., gain)
+        self.assertTrue(envelope.t0 <= 3600. < envelope.t0 + 0.0002)
+
+    def test_json_round_trip(self):
+        for envelope in (DriftEnvelope(0.3, 10.),
+                         DayNightEnvelope([[22, 0.5], [6, 1]]),
+                         FadeOutEnvelope(3600., 300.)):
+            data = json.loads(json.dumps(envelope.to_json()))
+            self.assertEqual(envelope_from_json(data).to_json(),
+                             envelope.to_json())
+
+    def test_invalid_envelopes(self):
+        for data in ('[]', '{}', '{"type": "echo"}',
+                     '{"type": "drift", "depth": 2}',
+                     '{"type": "drift", "period": 0}',
+                     '{"type": "drift", "period": NaN}',
+                     '{"type": "drift", "period": Infinity}',
+                     '{"type": "daynight", "points": []}',
+                     '{"type": "daynight", "points": [[24, 1]]}',
+                     '{"type": "daynight", "points": [[1, NaN]]}',
+                     '{"type": "fadeout"}',
+                     '{"type": "fadeout", "delay": -1}',
+                     '{"type": "fadeout", "delay": NaN}',
+                     '{"type": "fadeout", "delay": 1, "duration": Infinity}'):
+            self.assertRaises(ValueError, envelope_from_json, json.loads(data))
+
+class PresetTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "preset.json")
+
+        self.master = FakeMasterVolume()
+        self.rain = Sound("rain.ogg", self.master)
+        self.master.sounds.append(self.rain)
+        self.preset = Preset(self.master, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, filename, content):
+        with open(filename, "w") as f:
+            f.write(content)
+
+    def read_file(self, filename):
+        with open(filename, "r") as f:
+            return f.read()
+
+    def test_write_and_read(self):
+        self.preset.volumes = {"rain": 40}
+        self.preset.write()
+
+        preset = Preset(self.master, self.filename)
+        self.assertTrue(preset.read())
+        self.assertEqual(preset.volumes, {"rain": 40})
+        self.assertEqual(os.listdir(self.directory), ["preset.json"])
+
+    def test_write_keeps_previous_file(self):
+        """
+        The preset file always exists while it is replaced, and the
+        previous version becomes the backup
+        """
+        self.preset.volumes = {"rain": 40}
+        self.preset.write()
+
+        rename = os.rename
+        def checked_rename(source, destination):
+            self.assertTrue(os.path.isfile(self.filename))
+            rename(source, destination)
+            self.assertTrue(os.path.isfile(self.filename))
+
+        os.rename = checked_rename
+        try:
+            self.preset.volumes = {"rain": 60}
+            self.preset.write()
+        finally:
+            os.rename = rename
+
+        self.assertEqual(json.loads(self.read_file(self.filename)),
+                         {"rain": 60})
+        self.assertEqual(json.loads(self.read_file(self.filename + ".bak")),
+                         {"rain": 40})
+
+    def test_read_falls_back_to_backup(self):
+        self.write_file(self.filename, '{"rain": 4')
+        self.write_file(self.filename + ".bak", '{"rain": 30}')
+
+        self.assertTrue(self.preset.read())
+        self.assertEqual(self.preset.volumes, {"rain": 30})
+
+    def test_read_fails_without_valid_file(self):
+        self.write_file(self.filename, '{"rain": 4')
+        self.write_file(self.filename + ".bak", '{"rain": 300}')
+
+        self.assertFalse(self.preset.read())
+        self.assertEqual(self.preset.volumes, {})
+
+    def test_write_does_not_back_up_invalid_file(self):
+        self.write_file(self.filename, '{"rain": 4')
+        self.write_file(self.filename + ".bak", '{"rain": 30}')
+
+        self.preset.volumes = {"rain": 40}
+        self.preset.write()
+
+        self.assertEqual(json.loads(self.read_file(self.filename)),
+                         {"rain": 40})
+        self.assertEqual(json.loads(self.read_file(self.filename + ".bak")),
+                         {"rain": 30})
+
+    def test_load_automation(self):
+        data = {"rain": {"volume": 60,
+                         "automation": [{"type": "fadeout", "delay": 3600.,
+                                         "duration": 300.}]},
+                "fire": 40}
+        self.write_file(self.filename, json.dumps(data))
+
+        volumes, automation = self.preset._load(self.filename)
+        self.assertEqual(volumes, {"rain": 60, "fire": 40})
+        self.assertEqual(automation, {"rain": data["rain"]["automation"]})
+
+        self.preset.volumes = volumes
+        self.preset.automation = automation
+        self.assertEqual(self.preset.to_json(), data)
+
+    def test_save_stores_envelopes(self):
+        envelope = FadeOutEnvelope(3600., 300.)
+        self.rain.set_envelopes([envelope])
+        self.rain.set_volume(60)
+
+        self.preset.save()
+        self.assertEqual(self.preset.to_json(),
+                         {"rain": {"volume": 60,
+                                   "automation": [envelope.to_json()]}})
+
+    def test_load_rejects_invalid_presets(self):
+        for content in ('[]', '"rain"', '{"rain": true}', '{"rain": -1}',
+                        '{"rain": 101}', '{"rain": 50.5}', '{"rain": "50"}',
+                        '{"rain": {"automation": []}}',
+                        '{"rain": {"volume": 50, "automation": {}}}',
+                        '{"rain": {"volume": 50, "automation": [{}]}}'):
+            self.write_file(self.filename, content)
+            self.assertRaises(ValueError, self.preset._load, self.filename)
+
+class AutoSaverTest(unittest.TestCase):
+    def setUp(self):
+        self.master = FakeMasterVolume()
+        self.rain = Sound("rain.ogg", self.master)
+        self.master.sounds.append(self.rain)
+        self.preset = Preset(self.master, "preset.json")
+
+        # Record the writes instead of writing a file
+        self.writes = []
+        self.preset.write = lambda: self.writes.append(self.preset.to_json())
+
+        self.autosaver = AutoSaver(self.preset)
+
+    def test_save_skips_unchanged_presets(self):
+        self.assertTrue(self.autosaver.save())
+        self.assertEqual(self.writes, [])
+
+        self.rain.volume = 40
+        self.assertTrue(self.autosaver.save())
+        self.assertTrue(self.autosaver.save())
+        self.assertEqual(self.writes, [{"rain": 40}])
+
+    def test_save_reports_errors(self):
+        def write():
+            raise IOError("disk full")
+        self.preset.write = write
+
+        self.rain.volume = 40
+        self.assertFalse(self.autosaver.save())
+        self.assertTrue("disk full" in self.autosaver.error)
+
+        self.preset.write = lambda: None
+        self.assertTrue(self.autosaver.save())
+        self.assertEqual(self.autosaver.error, None)
+
+    def test_flush_waits_for_write_in_progress(self):
+        started = threading.Event()
+        finish = threading.Event()
+        def write():
+            started.set()
+            finish.wait()
+            self.writes.append(self.preset.to_json())
+        self.preset.write = write
+
+        self.rain.volume = 40
+        saving = threading.Thread(target=self.autosaver.save)
+        saving.start()
+        self.assertTrue(started.wait(5))
+
+        flushing = threading.Thread(target=self.autosaver.flush)
+        flushing.start()
+        flushing.join(0.05)
+        self.assertTrue(flushing.is_alive())
+
+        finish.set()
+        flushing.join()
+        saving.join()
+        self.assertEqual(self.writes, [{"rain": 40}])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -83,6 +83,10 @@ class VolumeWidget(OneLineWidget):
         # Draw the name
         self.parent.addstr(y, 0, " "+self.volume.name+" ", attribute)
 
+        # Indicate that the volume is modified by automation envelopes
+        if self.volume.is_automated():
+            self.parent.addstr(y, self.namesw+2, "~")
+
         # Position and width of the slider
         slidex = self.namesw+5
         slidew = width-slidex-2-1
@@ -251,10 +255,44 @@ class VolumeList(ScrollableList):
 
         self.set_widgets(widgets, 2)
 
+        self.statuspad = curses.newpad(1,1)
+
+    def get_status(self):
+        """
+        Return the text of the status line
+        """
+        if self.mastervolume.get_autosave():
+            status = "Autosave: on"
+        else:
+            status = "Autosave: off"
+
+        error = self.mastervolume.get_preset_error()
+        if error != None:
+            status += " - Error: " + error
+
+        return status
+
+    def draw(self, stop, sleft, sbottom, sright):
+        """
+        Draw the list, and the status line at the bottom of the portion
+        of the screen delimited by the coordinates (stop, sleft, sbottom,
+        sright)
+        """
+        ScrollableList.draw(self, stop, sleft, max(stop, sbottom-2), sright)
+
+        width = sright-sleft
+
+        self.statuspad.clear()
+        self.statuspad.resize(1, max(1, width+1))
+        self.statuspad.addstr(0, 0, self.get_status()[:width])
+        self.statuspad.refresh(0, 0, sbottom, sleft, sbottom, sright)
+
     def on_key(self, c, ui):
         if not ScrollableList.on_key(self, c, ui):
             if c == ord("s"):
                 self.mastervolume.save_preset()
+            elif c == ord("a"):
+                self.mastervolume.toggle_autosave()
             else:
                 return False
         return True
@@ -377,9 +415,22 @@ class UI:
         self.resize()
         self.update()
 
+        # Stop waiting for user input regularly, in order to display the
+        # errors occurring in the background
+        self.screen.timeout(1000)
+        status = self.volumelist.get_status()
+
         while True:
             # Wait for user input and handle it
-            self.on_key(self.screen.getch(), self)
+            c = self.screen.getch()
+            if c == -1:
+                # Only redraw the screen if the status changed
+                if self.volumelist.get_status() == status:
+                    continue
+            else:
+                self.on_key(c, self)
+
+            status = self.volumelist.get_status()
             self.update()
 
     def on_key(self, c, ui):
@@ -388,6 +439,7 @@ class UI:
         """
         if c == ord('q'):
             # Quit
+            self.volumelist.mastervolume.close()
             self.end()
             sys.exit(0)
         elif c == curses.KEY_HOME: